@@ -1,23 +1,47 @@
 from __future__ import annotations
 
-import json
+import hashlib
+import hmac
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
 from pathlib import Path
 
 import logging
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import Response, StreamingResponse
+import orjson
 from pydantic import BaseModel, Field
 
 from .rag_service import RagService
+from .settings import get_settings
 
 
 ROOT_DIR = Path(__file__).resolve().parents[1]
 INDEX_HTML = ROOT_DIR / "index.html"
 PORTAL_HTML = ROOT_DIR / "rutoken_portal.html"
 
-app = FastAPI(title="Rutoken Docs AI Assistant")
+
+def _load_static(path: Path) -> tuple[bytes, str]:
+    body = path.read_bytes()
+    return body, f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+
+
+# Pages are read once at import; edits are picked up only after a restart
+# (run_local.ps1 also reloads on *.html changes).
+INDEX_BYTES, INDEX_ETAG = _load_static(INDEX_HTML)
+PORTAL_BYTES, PORTAL_ETAG = _load_static(PORTAL_HTML)
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+    await rag.start()
+    yield
+    await rag.aclose()
+
+
+app = FastAPI(title="Rutoken Docs AI Assistant", lifespan=lifespan)
 logger = logging.getLogger("rutoken.rag")
 if not logger.handlers:
     logging.basicConfig(level=logging.INFO)
@@ -30,7 +54,7 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-rag = RagService()
+rag = RagService(get_settings())
 
 
 class ChatMessage(BaseModel):
@@ -61,26 +85,41 @@ class AssistantResponse(BaseModel):
 
 
 @app.get("/health")
-def health() -> dict:
+async def health() -> dict:
     return {"status": "ok"}
 
 
+def _html_response(request: Request, body: bytes, etag: str) -> Response:
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=300"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = {t.strip().removeprefix("W/") for t in if_none_match.split(",")}
+        if etag in tags or "*" in tags:
+            return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="text/html", headers=headers)
+
+
 @app.get("/")
-def root() -> FileResponse:
-    return FileResponse(INDEX_HTML)
+async def root(request: Request) -> Response:
+    return _html_response(request, INDEX_BYTES, INDEX_ETAG)
 
 
 @app.get("/rutoken_portal.html")
-def portal_html() -> FileResponse:
-    return FileResponse(PORTAL_HTML)
+async def portal_html(request: Request) -> Response:
+    return _html_response(request, PORTAL_BYTES, PORTAL_ETAG)
+
+
+def _history_dicts(payload: AssistantRequest) -> list[dict[str, str]]:
+    # Plain dicts straight from the attributes; model_dump() per message is not needed.
+    return [{"role": m.role, "content": m.content} for m in payload.history]
 
 
 @app.post("/api/assistant", response_model=AssistantResponse)
-def assistant(payload: AssistantRequest) -> AssistantResponse:
+async def assistant(payload: AssistantRequest) -> AssistantResponse:
     try:
-        answer, sources, followups, answer_id = rag.ask(
+        answer, sources, followups, answer_id = await rag.ask(
             question=payload.question.strip(),
-            history=[m.model_dump() for m in payload.history],
+            history=_history_dicts(payload),
             top_k=payload.top_k,
         )
         return AssistantResponse(
@@ -97,19 +136,19 @@ def assistant(payload: AssistantRequest) -> AssistantResponse:
 
 
 @app.post("/api/assistant/stream")
-def assistant_stream(payload: AssistantRequest):
-    def _event_stream():
+async def assistant_stream(payload: AssistantRequest):
+    async def _event_stream():
         try:
-            for ev in rag.stream_answer(
+            async for ev in rag.stream_answer(
                 question=payload.question.strip(),
-                history=[m.model_dump() for m in payload.history],
+                history=_history_dicts(payload),
                 top_k=payload.top_k,
             ):
-                yield f"data: {json.dumps(ev, ensure_ascii=False)}\n\n"
+                yield b"data: " + orjson.dumps(ev, option=orjson.OPT_NON_STR_KEYS) + b"\n\n"
         except Exception as exc:
             logger.exception("assistant_stream_failed")
             err = {"type": "error", "error": f"assistant_stream_failed: {exc}"}
-            yield f"data: {json.dumps(err, ensure_ascii=False)}\n\n"
+            yield b"data: " + orjson.dumps(err) + b"\n\n"
 
     return StreamingResponse(_event_stream(), media_type="text/event-stream")
 
@@ -122,7 +161,7 @@ class FeedbackRequest(BaseModel):
 
 
 @app.post("/api/assistant/feedback")
-def assistant_feedback(payload: FeedbackRequest) -> dict:
+async def assistant_feedback(payload: FeedbackRequest) -> dict:
     try:
         rag.save_feedback(
             answer_id=payload.answer_id,
@@ -134,3 +173,13 @@ def assistant_feedback(payload: FeedbackRequest) -> dict:
     except Exception as exc:
         logger.exception("feedback_failed")
         raise HTTPException(status_code=500, detail=f"feedback_failed: {exc}") from exc
+
+
+@app.post("/api/assistant/cache/invalidate")
+async def assistant_cache_invalidate(x_admin_token: str | None = Header(default=None)) -> dict:
+    # Without a configured token the endpoint does not exist for callers.
+    if not rag.admin_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token.encode(), rag.admin_token.encode()):
+        raise HTTPException(status_code=403, detail="forbidden")
+    return {"ok": True, "dropped": rag.invalidate_cache()}
@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+from typing import Any
+
+import numpy as np
+
+
+def _decode(embedding: str | list[float]) -> np.ndarray:
+    if isinstance(embedding, str):
+        return np.frombuffer(base64.b64decode(embedding), dtype=np.float32)
+    return np.asarray(embedding, dtype=np.float32)
+
+
+class EmbeddingBatcher:
+    """Coalesces concurrent embedding requests into one OpenAI call.
+
+    Questions submitted within ``batch_window_ms`` of the first queued one (or
+    until ``max_batch`` are collected) are sent as a single
+    ``embeddings.create(input=[...])`` request and each waiter receives its own
+    vector back. Vectors are requested base64-encoded and decoded straight into
+    float32 arrays, skipping the per-float JSON round trip.
+    """
+
+    def __init__(self, client: Any, model: str, batch_window_ms: float = 15, max_batch: int = 32) -> None:
+        self.client = client
+        self.model = model
+        self.batch_window = max(batch_window_ms, 0) / 1000
+        self.max_batch = max(max_batch, 1)
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._queue: asyncio.Queue[tuple[str, asyncio.Future[np.ndarray]]] | None = None
+        self._worker: asyncio.Task[None] | None = None
+        self._inflight: set[asyncio.Task[None]] = set()
+
+    def _ensure_worker(self) -> asyncio.Queue[tuple[str, asyncio.Future[np.ndarray]]]:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._queue is None or self._worker is None or self._worker.done():
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run(self._queue))
+        return self._queue
+
+    async def submit(self, text: str) -> np.ndarray:
+        queue = self._ensure_worker()
+        fut: asyncio.Future[np.ndarray] = asyncio.get_running_loop().create_future()
+        queue.put_nowait((text, fut))
+        return await fut
+
+    async def _run(self, queue: asyncio.Queue[tuple[str, asyncio.Future[np.ndarray]]]) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                if not queue.empty():
+                    batch.append(queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Flush in the background so the next window opens while this batch is in flight.
+            task = loop.create_task(self._flush(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _flush(self, batch: list[tuple[str, asyncio.Future[np.ndarray]]]) -> None:
+        try:
+            r = await self.client.embeddings.create(
+                model=self.model,
+                input=[text for text, _ in batch],
+                encoding_format="base64",
+            )
+        except Exception as exc:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(exc)
+            return
+        except asyncio.CancelledError:
+            for _, fut in batch:
+                fut.cancel()
+            raise
+        for (_, fut), item in zip(batch, sorted(r.data, key=lambda d: d.index)):
+            if not fut.done():
+                fut.set_result(_decode(item.embedding))
+        # A short response must not leave the remaining waiters hanging forever.
+        for _, fut in batch[len(r.data) :]:
+            if not fut.done():
+                fut.set_exception(RuntimeError(f"embeddings response has {len(r.data)} items for {len(batch)} inputs"))
+
+    async def aclose(self) -> None:
+        tasks = [*self._inflight]
+        if self._worker is not None:
+            tasks.append(self._worker)
+        for task in tasks:
+            task.cancel()
+        if tasks and self._loop is asyncio.get_running_loop():
+            await asyncio.gather(*tasks, return_exceptions=True)
+        # Questions still queued for the next window would otherwise wait forever.
+        while self._queue is not None and not self._queue.empty():
+            _, fut = self._queue.get_nowait()
+            fut.cancel()
+        self._worker = None
+        self._queue = None
+        self._inflight.clear()
@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from pathlib import Path
+from typing import Any
+
+import orjson
+
+
+class FeedbackLog:
+    """Append-only JSONL log of answer votes.
+
+    ``append`` only enqueues the event; a single background task drains up to
+    ``max_batch`` events per ``write()`` call and fsyncs at most once every
+    ``fsync_interval`` seconds, so the feedback endpoint never waits on disk.
+    """
+
+    def __init__(self, path: Path, max_batch: int = 64, fsync_interval: float = 5.0) -> None:
+        self.path = path
+        self.max_batch = max(max_batch, 1)
+        self.fsync_interval = fsync_interval
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._fh = open(self.path, "ab", buffering=0)
+        self._last_fsync = time.monotonic()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._queue: asyncio.Queue[dict[str, Any] | None] | None = None
+        self._worker: asyncio.Task[None] | None = None
+
+    def _ensure_worker(self) -> asyncio.Queue[dict[str, Any] | None]:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._queue is None or self._worker is None or self._worker.done():
+            pending = self._queue
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            # Carry over events queued on a previous loop that never got written.
+            while pending is not None and not pending.empty():
+                self._queue.put_nowait(pending.get_nowait())
+            self._worker = loop.create_task(self._run(self._queue))
+        return self._queue
+
+    def append(self, event: dict[str, Any]) -> None:
+        self._ensure_worker().put_nowait(event)
+
+    def _write(self, data: bytes) -> None:
+        self._fh.write(data)
+        now = time.monotonic()
+        if now - self._last_fsync >= self.fsync_interval:
+            os.fsync(self._fh.fileno())
+            self._last_fsync = now
+
+    async def _run(self, queue: asyncio.Queue[dict[str, Any] | None]) -> None:
+        closing = False
+        while not closing:
+            batch: list[dict[str, Any]] = []
+            item = await queue.get()
+            while True:
+                if item is None:
+                    closing = True
+                    break
+                batch.append(item)
+                if len(batch) >= self.max_batch or queue.empty():
+                    break
+                item = queue.get_nowait()
+            if batch:
+                await asyncio.to_thread(self._write, b"".join(orjson.dumps(ev) + b"\n" for ev in batch))
+
+    async def aclose(self) -> None:
+        if self._fh.closed:
+            return
+        queue = self._queue
+        worker = self._worker
+        if queue is not None and worker is not None and not worker.done() and self._loop is asyncio.get_running_loop():
+            queue.put_nowait(None)
+            await worker
+        elif queue is not None:
+            pending = []
+            while not queue.empty():
+                ev = queue.get_nowait()
+                if ev is not None:
+                    pending.append(ev)
+            self._fh.write(b"".join(orjson.dumps(ev) + b"\n" for ev in pending))
+        os.fsync(self._fh.fileno())
+        self._fh.close()
@@ -1,24 +1,29 @@
 ﻿from __future__ import annotations
 
-import json
+import asyncio
+import base64
+import hashlib
+import logging
 import os
-import uuid
-from pathlib import Path
-from typing import Any
+import time
+from collections import OrderedDict
+from collections.abc import AsyncIterator
+from typing import Any, ClassVar, Literal
 
-from dotenv import load_dotenv
-from openai import OpenAI
-from qdrant_client import QdrantClient
+import httpx
+import numpy as np
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, OpenAIError
+from pydantic import BaseModel, ConfigDict, ValidationError
+import tiktoken
+from qdrant_client import AsyncQdrantClient
 
+from .embedding_batcher import EmbeddingBatcher
+from .feedback_log import FeedbackLog
+from .semantic_cache import CachedAnswer, SemanticCache
+from .settings import Settings, get_settings
 
-def _load_env() -> None:
-    root = Path(__file__).resolve().parents[1]
-    env_file = root / ".env"
-    env_txt = root / ".env.txt"
-    if env_file.exists():
-        load_dotenv(env_file)
-    elif env_txt.exists():
-        load_dotenv(env_txt)
+
+logger = logging.getLogger("rutoken.rag")
 
 
 def _infer_https(url: str) -> bool | None:
@@ -29,48 +34,142 @@ def _infer_https(url: str) -> bool | None:
     return None
 
 
+class Followups(BaseModel):
+    model_config = ConfigDict(extra="forbid", str_strip_whitespace=True)
+
+    followups: list[str]
+
+
+_FOLLOWUPS_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "Followups", "schema": Followups.model_json_schema(), "strict": True},
+}
+
+
+def _answer_id() -> str:
+    return base64.urlsafe_b64encode(os.urandom(12)).decode()
+
+
+_CONTEXT_BLOCK = "[{label}] {title}\nsection: {section}\nurl: {url}\ntext: {snippet}"
+
+
+def _cosine(a: np.ndarray, b: np.ndarray) -> float:
+    denom = float(np.linalg.norm(a) * np.linalg.norm(b))
+    return float(a @ b) / denom if denom else 0.0
+
+
 class RagService:
-    def __init__(self) -> None:
-        _load_env()
-        self.openai_api_key = os.getenv("OPENAI_API_KEY") or ""
-        self.openai_chat_model = os.getenv("OPENAI_CHAT_MODEL", "gpt-4o-mini")
-        self.openai_embed_model = os.getenv("EMBED_MODEL", "text-embedding-3-large")
-        self.qdrant_url = os.getenv("QDRANT_URL") or ""
-        self.qdrant_api_key = os.getenv("QDRANT_API_KEY")
-        self.qdrant_collection = os.getenv("QDRANT_COLLECTION") or ""
-        self.default_top_k = int(os.getenv("RAG_TOP_K", "6"))
-        self.max_snippet_chars = int(os.getenv("RAG_SNIPPET_CHARS", "700"))
-        self.feedback_store: list[dict[str, Any]] = []
-
-        if not self.openai_api_key:
-            raise ValueError("OPENAI_API_KEY is required")
-        if not self.qdrant_url:
-            raise ValueError("QDRANT_URL is required")
-        if not self.qdrant_collection:
-            raise ValueError("QDRANT_COLLECTION is required")
-
-        self.openai = OpenAI(api_key=self.openai_api_key)
-        self.qdrant = QdrantClient(
+    # Shared by every request; the OpenAI client only serializes it, never mutates it.
+    _SYSTEM_MSG: ClassVar[dict[str, str]] = {
+        "role": "system",
+        "content": (
+            "Ты встроенный AI-помощник портала документации Рутокен. "
+            "Отвечай только на основе переданного контекста. "
+            "Если данных недостаточно, явно скажи это и предложи, что уточнить. "
+            "Пиши кратко и по делу. "
+            "Для фактических утверждений добавляй ссылки на источники в формате [S1], [S2]."
+        ),
+    }
+
+    def __init__(self, settings: Settings | None = None) -> None:
+        settings = settings or get_settings()
+        self.settings = settings
+        self.openai_api_key = settings.openai_api_key.get_secret_value()
+        self.openai_chat_model = settings.openai_chat_model
+        self.openai_embed_model = settings.embed_model
+        self.qdrant_url = settings.qdrant_url
+        self.qdrant_api_key = settings.qdrant_api_key.get_secret_value() if settings.qdrant_api_key else None
+        self.qdrant_collection = settings.qdrant_collection
+        self.qdrant_prefer_grpc = settings.qdrant_prefer_grpc
+        self.qdrant_grpc_port = settings.qdrant_grpc_port
+        self.default_top_k = settings.rag_top_k
+        self.max_snippet_chars = settings.rag_snippet_chars
+        self.history_token_budget = settings.rag_history_tokens
+        self._encoder: tiktoken.Encoding | Literal[False] | None = None
+        self.http_limits = httpx.Limits(
+            max_connections=settings.rag_max_connections,
+            max_keepalive_connections=settings.rag_max_keepalive,
+        )
+        self.admin_token = settings.rag_admin_token
+        self.prefetch_max = settings.rag_prefetch_max
+        self.prefetch_min_cos = settings.rag_prefetch_min_cos
+        self.prefetch_vectors: OrderedDict[str, np.ndarray] = OrderedDict()
+        self.search_cache_ttl = settings.rag_search_cache_ttl
+        self.search_cache_max = settings.rag_search_cache_max
+        self.search_cache: OrderedDict[tuple[bytes, int], tuple[float, list[Any]]] = OrderedDict()
+        self.semantic_cache = SemanticCache(
+            tau=settings.rag_semcache_tau,
+            max_entries=settings.rag_semcache_max,
+            region_tau=settings.rag_semcache_region_tau,
+            use_numba=settings.rag_semcache_numba,
+            int8=settings.rag_semcache_int8,
+        )
+        # Workers share nothing but the filesystem; invalidation replaces this
+        # file and every worker drops its caches once it sees the new stamp.
+        self.cache_generation_file = settings.rag_cache_generation_file
+        self._cache_generation = self._read_cache_generation()
+
+        self.openai = AsyncOpenAI(
+            api_key=self.openai_api_key,
+            timeout=60.0,
+            # HTTP/2 multiplexes the concurrent embedding / chat / followup calls
+            # over a few kept-alive connections instead of a TLS handshake each.
+            http_client=DefaultAsyncHttpxClient(
+                http2=settings.rag_http2,
+                limits=self.http_limits,
+            ),
+        )
+        self.qdrant = AsyncQdrantClient(
             url=self.qdrant_url,
             api_key=self.qdrant_api_key,
             https=_infer_https(self.qdrant_url),
             port=None,
+            grpc_port=self.qdrant_grpc_port,
+            prefer_grpc=self.qdrant_prefer_grpc,
             timeout=60,
+            limits=self.http_limits,
+            http2=settings.rag_http2,
         )
+        self.embed_batcher = EmbeddingBatcher(
+            self.openai,
+            self.openai_embed_model,
+            batch_window_ms=settings.rag_embed_batch_window_ms,
+            max_batch=settings.rag_embed_max_batch,
+        )
+        self.feedback_log = FeedbackLog(settings.rag_feedback_log)
+
+    async def _embed_query(self, question: str) -> np.ndarray:
+        return await self.embed_batcher.submit(question)
 
-    def _embed_query(self, question: str) -> list[float]:
-        r = self.openai.embeddings.create(model=self.openai_embed_model, input=[question])
-        return r.data[0].embedding
+    async def _search(self, vector: np.ndarray, top_k: int) -> list[Any]:
+        # Vectors are rounded before hashing so retries / refreshes of the same
+        # question collapse onto a single Qdrant call within the TTL.
+        digest = hashlib.blake2b(np.round(vector, 3).tobytes(), digest_size=16).digest()
+        key = (digest, top_k)
+        now = time.monotonic()
+        entry = self.search_cache.get(key)
+        if entry is not None:
+            if now - entry[0] <= self.search_cache_ttl:
+                self.search_cache.move_to_end(key)
+                return entry[1]
+            del self.search_cache[key]
 
-    def _search(self, vector: list[float], top_k: int) -> list[Any]:
+        hits = await self._search_qdrant(vector, top_k)
+        if self.search_cache_max > 0:
+            self.search_cache[key] = (now, hits)
+            while len(self.search_cache) > self.search_cache_max:
+                self.search_cache.popitem(last=False)
+        return hits
+
+    async def _search_qdrant(self, vector: np.ndarray, top_k: int) -> list[Any]:
         if hasattr(self.qdrant, "search"):
-            return self.qdrant.search(  # type: ignore[attr-defined]
+            return await self.qdrant.search(  # type: ignore[attr-defined]
                 collection_name=self.qdrant_collection,
                 query_vector=vector,
                 limit=top_k,
                 with_payload=True,
             )
-        qr = self.qdrant.query_points(
+        qr = await self.qdrant.query_points(
             collection_name=self.qdrant_collection,
             query=vector,
             limit=top_k,
@@ -78,77 +177,89 @@ class RagService:
         )
         return list(qr.points)
 
-    def _normalize_sources(self, hits: list[Any]) -> list[dict[str, Any]]:
+    def _normalize_and_format(self, hits: list[Any]) -> tuple[list[dict[str, Any]], str]:
+        limit = self.max_snippet_chars
         sources: list[dict[str, Any]] = []
-        for h in hits:
+        blocks: list[str] = []
+        for idx, h in enumerate(hits, start=1):
             payload = h.payload or {}
             text = str(payload.get("text") or "").strip()
-            snippet = text[: self.max_snippet_chars]
-            if len(text) > self.max_snippet_chars:
-                snippet += "..."
+            snippet = text[:limit] + "..." if len(text) > limit else text
             section = " / ".join(payload.get("header_path") or [])
+            title = str(payload.get("title") or "Документация Рутокен")
+            url = payload.get("source_url")
             sources.append(
                 {
-                    "title": str(payload.get("title") or "Документация Рутокен"),
-                    "url": payload.get("source_url"),
+                    "title": title,
+                    "url": url,
                     "doc_path": payload.get("doc_path"),
                     "section": section or None,
                     "score": float(getattr(h, "score", 0.0) or 0.0),
                     "snippet": snippet,
                 }
             )
-        return sources
-
-    def _build_context(self, sources: list[dict[str, Any]]) -> str:
-        blocks: list[str] = []
-        for idx, src in enumerate(sources, start=1):
-            label = f"S{idx}"
-            title = src["title"]
-            section = src.get("section") or "-"
-            url = src.get("url") or "-"
-            snippet = src.get("snippet") or "-"
             blocks.append(
-                f"[{label}] {title}\n"
-                f"section: {section}\n"
-                f"url: {url}\n"
-                f"text: {snippet}"
+                _CONTEXT_BLOCK.format(
+                    label=f"S{idx}",
+                    title=title,
+                    section=section or "-",
+                    url=url or "-",
+                    snippet=snippet or "-",
+                )
             )
-        return "\n\n".join(blocks)
+        return sources, "\n\n".join(blocks)
 
     def _build_messages(self, question: str, history: list[dict[str, str]], context: str) -> list[dict[str, str]]:
-        system = (
-            "Ты встроенный AI-помощник портала документации Рутокен. "
-            "Отвечай только на основе переданного контекста. "
-            "Если данных недостаточно, явно скажи это и предложи, что уточнить. "
-            "Пиши кратко и по делу. "
-            "Для фактических утверждений добавляй ссылки на источники в формате [S1], [S2]."
+        user_content = (
+            f"Вопрос пользователя:\n{question}\n\n"
+            f"Контекст из базы знаний:\n{context}\n\n"
+            "Сформируй ответ на русском языке."
         )
+        return [self._SYSTEM_MSG, *self._trim_history(history), {"role": "user", "content": user_content}]
 
-        messages: list[dict[str, str]] = [{"role": "system", "content": system}]
-        if history:
-            messages.extend(history[-8:])
-        messages.append(
-            {
-                "role": "user",
-                "content": (
-                    f"Вопрос пользователя:\n{question}\n\n"
-                    f"Контекст из базы знаний:\n{context}\n\n"
-                    "Сформируй ответ на русском языке."
-                ),
-            }
-        )
-        return messages
+    def _load_encoder(self) -> tiktoken.Encoding | Literal[False]:
+        try:
+            try:
+                return tiktoken.encoding_for_model(self.openai_chat_model)
+            except KeyError:
+                return tiktoken.get_encoding("o200k_base")
+        except Exception:
+            # BPE files could not be fetched; fall back to a rough
+            # chars-per-token estimate rather than failing requests.
+            return False
 
-    def _generate_answer(self, question: str, history: list[dict[str, str]], context: str) -> str:
+    async def start(self) -> None:
+        # Loading the BPE ranks reads (or downloads) a multi-MB file; do it once
+        # off the event loop at startup instead of inside the first request.
+        if self._encoder is None:
+            self._encoder = await asyncio.to_thread(self._load_encoder)
+
+    def _count_tokens(self, text: str) -> int:
+        if not self._encoder:
+            return len(text) // 3
+        return len(self._encoder.encode(text, disallowed_special=()))
+
+    def _trim_history(self, history: list[dict[str, str]]) -> list[dict[str, str]]:
+        # Keep the newest messages that fit into the token budget.
+        kept = 0
+        budget = self.history_token_budget
+        for m in reversed(history[-8:]):
+            budget -= self._count_tokens(m["content"])
+            if budget < 0:
+                break
+            kept += 1
+        return history[len(history) - kept :]
+
+    async def _generate_answer(self, question: str, history: list[dict[str, str]], context: str) -> str:
         messages = self._build_messages(question, history, context)
-        out = self.openai.chat.completions.create(
+        out = await self.openai.chat.completions.create(
             model=self.openai_chat_model,
             temperature=0.2,
             messages=messages,
         )
         return (out.choices[0].message.content or "").strip()
 
-    def _generate_followups(self, question: str, answer: str, sources: list[dict[str, Any]]) -> list[str]:
+    async def _generate_followups(self, question: str, answer: str, sources: list[dict[str, Any]]) -> list[str]:
         src_titles = ", ".join([s.get("title", "") for s in sources[:4] if s.get("title")])
         prompt = (
             "Сгенерируй 4 коротких уточняющих вопроса пользователя по теме ответа. "
@@ -158,19 +269,15 @@ class RagService:
             f"Источники: {src_titles}"
         )
         try:
-            out = self.openai.chat.completions.create(
+            out = await self.openai.chat.completions.create(
                 model=self.openai_chat_model,
                 temperature=0.4,
                 messages=[{"role": "user", "content": prompt}],
-                response_format={"type": "json_object"},
+                response_format=_FOLLOWUPS_RESPONSE_FORMAT,
             )
-            content = (out.choices[0].message.content or "").strip()
-            parsed = json.loads(content)
-            items = parsed.get("followups") if isinstance(parsed, dict) else None
-            if isinstance(items, list):
-                clean = [str(x).strip() for x in items if str(x).strip()]
-                return clean[:4]
-        except Exception:
+            parsed = Followups.model_validate_json(out.choices[0].message.content or "")
+            return [x for x in parsed.followups if x][:4]
+        except (OpenAIError, ValidationError):
             pass
         return [
             "Какие шаги выполнить в Linux по порядку?",
@@ -179,14 +286,72 @@ class RagService:
             "Какие версии и компоненты должны быть установлены?",
         ]
 
-    def _retrieve(self, question: str, top_k: int | None = None) -> tuple[list[dict[str, Any]], str]:
-        vec = self._embed_query(question.strip())
-        hits = self._search(vec, top_k or self.default_top_k)
-        sources = self._normalize_sources(hits)
-        context = self._build_context(sources)
-        return sources, context
+    def _cached_answer(self, vector: np.ndarray, history: list[dict[str, str]], top_k: int) -> CachedAnswer | None:
+        # Answers given inside a conversation depend on its history, so only
+        # standalone questions are served from / stored into the cache.
+        if history:
+            return None
+        return self.semantic_cache.lookup(vector, top_k)
+
+    def _remember_answer(
+        self,
+        vector: np.ndarray,
+        history: list[dict[str, str]],
+        top_k: int,
+        answer: str,
+        sources: list[dict[str, Any]],
+        followups: list[str],
+    ) -> None:
+        if not history and answer:
+            self.semantic_cache.put(vector, top_k, answer, sources, followups)
+
+    def _prefetch_key(self, question: str) -> str:
+        return question[:64].casefold()
+
+    def _remember_prefix(self, question: str, vector: np.ndarray) -> None:
+        key = self._prefetch_key(question)
+        self.prefetch_vectors[key] = vector
+        self.prefetch_vectors.move_to_end(key)
+        while len(self.prefetch_vectors) > self.prefetch_max:
+            self.prefetch_vectors.popitem(last=False)
+
+    async def _retrieve(
+        self,
+        question: str,
+        history: list[dict[str, str]],
+        top_k: int,
+    ) -> tuple[np.ndarray, CachedAnswer | None, list[dict[str, Any]], str]:
+        self._sync_cache_generation()
+        # If a question with the same prefix was seen before, search with its
+        # vector while the real embedding is in flight and keep those hits when
+        # both vectors turn out to be close enough.
+        guess = self.prefetch_vectors.get(self._prefetch_key(question))
+        search_task = asyncio.create_task(self._search(guess, top_k)) if guess is not None else None
+        try:
+            vec = await self._embed_query(question)
+            self._remember_prefix(question, vec)
+            cached = self._cached_answer(vec, history, top_k)
+            if cached is not None:
+                return vec, cached, cached.sources, ""
+            hits = None
+            if search_task is not None and _cosine(guess, vec) >= self.prefetch_min_cos:
+                try:
+                    hits = await search_task
+                except Exception:
+                    logger.warning("speculative_search_failed", exc_info=True)
+            if hits is None:
+                hits = await self._search(vec, top_k)
+        finally:
+            if search_task is not None:
+                if not search_task.done():
+                    search_task.cancel()
+                elif not search_task.cancelled():
+                    # Mark a discarded task's exception as retrieved so asyncio does not log it.
+                    search_task.exception()
+        sources, context = self._normalize_and_format(hits)
+        return vec, None, sources, context
 
-    def ask(
+    async def ask(
         self,
         question: str,
         history: list[dict[str, str]] | None = None,
@@ -194,32 +359,49 @@ class RagService:
     ) -> tuple[str, list[dict[str, Any]], list[str], str]:
         if not question.strip():
             raise ValueError("question is empty")
-        sources, context = self._retrieve(question.strip(), top_k)
-        answer = self._generate_answer(question.strip(), history or [], context)
-        followups = self._generate_followups(question.strip(), answer, sources)
-        answer_id = str(uuid.uuid4())
+        history = history or []
+        top_k = top_k or self.default_top_k
+        vec, cached, sources, context = await self._retrieve(question.strip(), history, top_k)
+        if cached is not None:
+            return cached.answer, sources, cached.followups, _answer_id()
+
+        answer = await self._generate_answer(question.strip(), history, context)
+        followups = await self._generate_followups(question.strip(), answer, sources)
+        answer_id = _answer_id()
+        self._remember_answer(vec, history, top_k, answer, sources, followups)
         return answer, sources, followups, answer_id
 
-    def stream_answer(
+    async def stream_answer(
         self,
         question: str,
         history: list[dict[str, str]] | None = None,
         top_k: int | None = None,
-    ):
+    ) -> AsyncIterator[dict[str, Any]]:
         if not question.strip():
             raise ValueError("question is empty")
+        history = history or []
+        top_k = top_k or self.default_top_k
+        vec, cached, sources, context = await self._retrieve(question.strip(), history, top_k)
+        if cached is not None:
+            yield {
+                "type": "final",
+                "answer": cached.answer,
+                "sources": sources,
+                "followups": cached.followups,
+                "answer_id": _answer_id(),
+            }
+            return
 
-        sources, context = self._retrieve(question.strip(), top_k)
-        messages = self._build_messages(question.strip(), history or [], context)
+        messages = self._build_messages(question.strip(), history, context)
 
         answer_chunks: list[str] = []
-        stream = self.openai.chat.completions.create(
+        stream = await self.openai.chat.completions.create(
             model=self.openai_chat_model,
             temperature=0.2,
             messages=messages,
             stream=True,
         )
-        for chunk in stream:
+        async for chunk in stream:
             delta = chunk.choices[0].delta.content if chunk.choices else None
             if not delta:
                 continue
@@ -227,8 +409,9 @@ class RagService:
             yield {"type": "delta", "delta": delta}
 
         answer = "".join(answer_chunks).strip()
-        followups = self._generate_followups(question.strip(), answer, sources)
-        answer_id = str(uuid.uuid4())
+        followups = await self._generate_followups(question.strip(), answer, sources)
+        answer_id = _answer_id()
+        self._remember_answer(vec, history, top_k, answer, sources, followups)
         yield {
             "type": "final",
             "answer": answer,
@@ -238,11 +421,50 @@ class RagService:
         }
 
     def save_feedback(self, answer_id: str, vote: str, question: str | None = None, answer: str | None = None) -> None:
-        self.feedback_store.append(
+        self.feedback_log.append(
             {
+                "ts": time.time(),
                 "answer_id": answer_id,
                 "vote": vote,
                 "question": question,
                 "answer": answer,
             }
         )
+
+    def _read_cache_generation(self) -> tuple[int, int] | None:
+        try:
+            st = self.cache_generation_file.stat()
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns
+
+    def _sync_cache_generation(self) -> None:
+        generation = self._read_cache_generation()
+        if generation != self._cache_generation:
+            self._cache_generation = generation
+            self._clear_caches()
+
+    def _clear_caches(self) -> None:
+        self.semantic_cache.clear()
+        self.search_cache.clear()
+
+    def invalidate_cache(self) -> int:
+        """Drop cached answers and search hits in every worker sharing the stamp file.
+
+        Returns the number of answers dropped by this worker; the others clear
+        theirs on their next request.
+        """
+        dropped = len(self.semantic_cache)
+        self._clear_caches()
+        path = self.cache_generation_file
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp.write_bytes(os.urandom(8).hex().encode())
+        os.replace(tmp, path)
+        self._cache_generation = self._read_cache_generation()
+        return dropped
+
+    async def aclose(self) -> None:
+        await self.embed_batcher.aclose()
+        await self.feedback_log.aclose()
+        await self.openai.close()
+        await self.qdrant.close()
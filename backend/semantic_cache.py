@@ -0,0 +1,242 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Any
+
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:  # pragma: no cover - numba is an optional accelerator
+    njit = None
+
+
+_INT8_CHUNK_ROWS = 4096
+# fastmath=True would also enable nnan/ninf, letting LLVM assume the -inf
+# "no match" sentinel never occurs; keep only the flags the dot product needs.
+_FASTMATH = {"contract", "reassoc", "arcp", "nsz", "afn"}
+
+
+def _best_match_numpy(E, q, row_scale, q_scale, row_tau, row_top_k, top_k):  # type: ignore[no-untyped-def]
+    if E.dtype == np.int8:
+        # numpy has no int8 BLAS; widen a bounded chunk at a time so the scan
+        # never materializes a float copy of the whole matrix.
+        qf = q.astype(np.float32)
+        sims = np.empty(E.shape[0], dtype=np.float32)
+        for start in range(0, E.shape[0], _INT8_CHUNK_ROWS):
+            stop = start + _INT8_CHUNK_ROWS
+            sims[start:stop] = E[start:stop].astype(np.float32) @ qf
+        sims *= row_scale * np.float32(q_scale)
+    else:
+        sims = E @ q
+    sims[(sims < row_tau) | (row_top_k != top_k)] = -np.inf
+    best = int(sims.argmax())
+    if sims[best] == -np.inf:
+        return -1, -np.inf
+    return best, sims[best]
+
+
+if njit is not None:
+
+    @njit(parallel=True, fastmath=_FASTMATH, cache=True)
+    def _best_match_numba(E, q, row_scale, q_scale, row_tau, row_top_k, top_k):  # type: ignore[no-untyped-def]
+        # One pass over E: dot product, per-row threshold and top_k filter are
+        # fused; only the final argmax walks the (N,) score vector.
+        n, d = E.shape
+        sims = np.full(n, -np.inf, dtype=np.float32)
+        for i in prange(n):
+            if row_top_k[i] != top_k:
+                continue
+            s = np.float32(0.0)
+            for j in range(d):
+                s += E[i, j] * q[j]
+            if s >= row_tau[i]:
+                sims[i] = s
+        best = -1
+        best_s = -np.inf
+        for i in range(n):
+            if sims[i] > best_s:
+                best_s = sims[i]
+                best = i
+        return best, best_s
+
+    @njit(parallel=True, fastmath=_FASTMATH, cache=True)
+    def _best_match_numba_int8(E, q, row_scale, q_scale, row_tau, row_top_k, top_k):  # type: ignore[no-untyped-def]
+        # Same scan over int8 rows with an explicit int32 accumulator, which
+        # LLVM can lower to VNNI / pmaddubsw-style dot products.
+        n, d = E.shape
+        sims = np.full(n, -np.inf, dtype=np.float32)
+        for i in prange(n):
+            if row_top_k[i] != top_k:
+                continue
+            acc = np.int32(0)
+            for j in range(d):
+                acc += np.int32(E[i, j]) * np.int32(q[j])
+            s = np.float32(acc) * row_scale[i] * q_scale
+            if s >= row_tau[i]:
+                sims[i] = s
+        best = -1
+        best_s = -np.inf
+        for i in range(n):
+            if sims[i] > best_s:
+                best_s = sims[i]
+                best = i
+        return best, best_s
+
+else:
+    _best_match_numba = None
+    _best_match_numba_int8 = None
+
+
+def _quantize(q: np.ndarray) -> tuple[np.ndarray, float]:
+    # Symmetric per-vector int8: the largest component maps to +/-127.
+    scale = float(np.abs(q).max()) / 127
+    return np.round(q / scale).astype(np.int8), scale
+
+
+@dataclass(frozen=True)
+class CachedAnswer:
+    answer: str
+    sources: list[dict[str, Any]]
+    followups: list[str]
+    score: float
+
+
+class SemanticCache:
+    """In-process answer cache keyed by question embedding.
+
+    Embeddings are kept L2-normalized in a dense ``(N, d)`` float32 matrix so a
+    lookup is a single scan over ``E``: a BLAS ``E @ q`` by default, or with
+    ``use_numba`` a parallel kernel fusing dot product, threshold and argmax.
+    With ``int8`` rows are stored quantized with one float scale each, cutting
+    the matrix (and the bytes a lookup has to stream) by 4x.
+    Every row is tagged with a region (the title of its top source) whose
+    threshold can be tuned independently of the global ``tau``; the least
+    recently used row is replaced once ``max_entries`` is reached.
+    """
+
+    def __init__(
+        self,
+        tau: float = 0.95,
+        max_entries: int = 10000,
+        region_tau: dict[str, float] | None = None,
+        use_numba: bool = False,
+        int8: bool = False,
+    ) -> None:
+        self.tau = tau
+        self.max_entries = max_entries
+        self.region_tau = dict(region_tau or {})
+        self.int8 = int8
+        self._dtype = np.int8 if int8 else np.float32
+        self._best_match = _best_match_numpy
+        if use_numba:
+            kernel = _best_match_numba_int8 if int8 else _best_match_numba
+            if kernel is None:
+                raise ValueError("use_numba requires the numba package")
+            self._best_match = kernel
+            # Compile (or load the cached build of) the kernel now, not on the first request.
+            self._best_match(
+                np.zeros((1, 1), dtype=self._dtype),
+                np.zeros(1, dtype=self._dtype),
+                np.ones(1, dtype=np.float32),
+                np.float32(1.0),
+                np.ones(1, dtype=np.float32),
+                np.zeros(1, dtype=np.int32),
+                0,
+            )
+        self.clear()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def clear(self) -> None:
+        self._E = np.empty((0, 0), dtype=self._dtype)
+        self._row_scale = np.empty(0, dtype=np.float32)
+        self._row_tau = np.empty(0, dtype=np.float32)
+        self._row_top_k = np.empty(0, dtype=np.int32)
+        self._last_used = np.empty(0, dtype=np.int64)
+        self._entries: list[tuple[str, list[dict[str, Any]], list[str]]] = []
+        self._size = 0
+        self._clock = 0
+
+    @staticmethod
+    def _normalize(vector: np.ndarray) -> np.ndarray | None:
+        q = np.asarray(vector, dtype=np.float32).ravel()
+        norm = float(np.linalg.norm(q))
+        if not norm:
+            return None
+        return q / norm
+
+    def _tick(self) -> int:
+        self._clock += 1
+        return self._clock
+
+    def lookup(self, vector: np.ndarray, top_k: int) -> CachedAnswer | None:
+        q = self._normalize(vector)
+        if q is None:
+            return None
+        if not self._size or self._E.shape[1] != q.shape[0]:
+            return None
+        n = self._size
+        q_scale = 1.0
+        if self.int8:
+            q, q_scale = _quantize(q)
+        best, score = self._best_match(
+            self._E[:n],
+            q,
+            self._row_scale[:n],
+            np.float32(q_scale),
+            self._row_tau[:n],
+            self._row_top_k[:n],
+            top_k,
+        )
+        if best < 0:
+            return None
+        best, score = int(best), float(score)
+        self._last_used[best] = self._tick()
+        answer, sources, followups = self._entries[best]
+        return CachedAnswer(answer=answer, sources=sources, followups=followups, score=score)
+
+    def _grow(self, dim: int) -> None:
+        capacity = min(self.max_entries, max(16, self._E.shape[0] * 2))
+        E = np.zeros((capacity, dim), dtype=self._dtype)
+        if self._size:
+            E[: self._size] = self._E[: self._size]
+        self._E = E
+        self._row_scale = np.resize(self._row_scale, capacity)
+        self._row_tau = np.resize(self._row_tau, capacity)
+        self._row_top_k = np.resize(self._row_top_k, capacity)
+        self._last_used = np.resize(self._last_used, capacity)
+
+    def put(
+        self,
+        vector: np.ndarray,
+        top_k: int,
+        answer: str,
+        sources: list[dict[str, Any]],
+        followups: list[str],
+    ) -> None:
+        q = self._normalize(vector)
+        if q is None or self.max_entries <= 0:
+            return
+        region = str(sources[0].get("title") or "") if sources else ""
+        if self._size and self._E.shape[1] != q.shape[0]:
+            # Embedding model changed; old rows are not comparable anymore.
+            self.clear()
+        if self._size < self.max_entries:
+            if self._size >= self._E.shape[0]:
+                self._grow(q.shape[0])
+            row = self._size
+            self._size += 1
+            self._entries.append((answer, sources, followups))
+        else:
+            row = int(self._last_used[: self._size].argmin())
+            self._entries[row] = (answer, sources, followups)
+        if self.int8:
+            self._E[row], self._row_scale[row] = _quantize(q)
+        else:
+            self._E[row] = q
+            self._row_scale[row] = 1.0
+        self._row_tau[row] = self.region_tau.get(region, self.tau)
+        self._row_top_k[row] = top_k
+        self._last_used[row] = self._tick()
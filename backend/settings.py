@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+from functools import lru_cache
+from pathlib import Path
+
+from pydantic import Field, SecretStr
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+
+
+class Settings(BaseSettings):
+    # Later env files win, so `.env` takes precedence over `.env.txt`; real
+    # environment variables override both.
+    model_config = SettingsConfigDict(
+        env_file=(ROOT_DIR / ".env.txt", ROOT_DIR / ".env"),
+        env_file_encoding="utf-8",
+        extra="ignore",
+    )
+
+    openai_api_key: SecretStr = Field(min_length=1)
+    openai_chat_model: str = "gpt-4o-mini"
+    embed_model: str = "text-embedding-3-large"
+
+    qdrant_url: str = Field(min_length=1)
+    qdrant_api_key: SecretStr | None = None
+    qdrant_collection: str = Field(min_length=1)
+    qdrant_prefer_grpc: bool = False
+    qdrant_grpc_port: int = 6334
+
+    rag_top_k: int = 6
+    rag_snippet_chars: int = 700
+    rag_history_tokens: int = 2000
+    rag_max_connections: int = 256
+    rag_max_keepalive: int = 128
+    rag_http2: bool = True
+    rag_embed_batch_window_ms: float = 15
+    rag_embed_max_batch: int = 32
+    rag_prefetch_max: int = 1024
+    rag_prefetch_min_cos: float = 0.95
+    rag_search_cache_ttl: float = 300
+    rag_search_cache_max: int = 512
+    rag_semcache_tau: float = 0.95
+    rag_semcache_max: int = 10000
+    rag_semcache_region_tau: dict[str, float] = Field(default_factory=dict)
+    rag_semcache_numba: bool = False
+    rag_semcache_int8: bool = False
+    rag_admin_token: str | None = None
+    rag_feedback_log: Path = ROOT_DIR / "feedback.log"
+    rag_cache_generation_file: Path = ROOT_DIR / "cache.generation"
+
+
+@lru_cache
+def get_settings() -> Settings:
+    return Settings()  # type: ignore[call-arg]
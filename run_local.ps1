@@ -6,7 +6,9 @@ if (!(Test-Path ".venv")) {
 
 .\.venv\Scripts\python.exe -m pip install -U pip
 .\.venv\Scripts\python.exe -m pip install -r requirements.txt
+# --reload-include (so HTML edits are served) only works with watchfiles installed.
+.\.venv\Scripts\python.exe -m pip install watchfiles
 
 Write-Host "Starting server at http://127.0.0.1:8080 ..."
-.\.venv\Scripts\python.exe -m uvicorn backend.app:app --host 127.0.0.1 --port 8080 --reload
+.\.venv\Scripts\python.exe -m uvicorn backend.app:app --host 127.0.0.1 --port 8080 --reload --reload-include "*.html"
 